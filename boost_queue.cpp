@@ -8,13 +8,17 @@
 #include "Python.h"
 
 #include <exception>
-#include <deque>
+#include <algorithm>
+#include <cstdlib>
+#include <cstring>
+#include <limits>
+#include <new>
+#include <boost/atomic.hpp>
 #include <boost/cstdint.hpp>
 #include <boost/date_time/posix_time/posix_time_types.hpp>
 #include <boost/thread/condition_variable.hpp>
 #include <boost/thread/mutex.hpp>
 #include <boost/thread/thread_time.hpp>
-#include <boost/foreach.hpp>
 
 /* get_many considarations:
  * Avoid using get_many() on the consumer side and using put() on the producer.
@@ -27,6 +31,8 @@
 /* Macro to wrap c++ exceptions into python ones */
 #define BEGIN_SAFE_CALL try {
 #define END_SAFE_CALL(error_txt1, ret_val) } \
+    catch (std::bad_alloc &e) { \
+        PyErr_NoMemory(); return ret_val;} \
     catch (std::exception &e) { \
         PyErr_Format(PyExc_Exception, error_txt1, e.what()); return ret_val;} \
     catch (...) { \
@@ -41,6 +47,7 @@ class AllowThreads {
         ~AllowThreads(){Py_BLOCK_THREADS}
 };
 
+static const char *init_kwlist[] = {"maxsize", "spsc", NULL};
 static const char *put_kwlist[] = {"item", "block", "timeout", NULL};
 static const char *put_many_kwlist[] = {"items", "block", "timeout", NULL};
 static const char *get_kwlist[] = {"block", "timeout", NULL};
@@ -50,20 +57,277 @@ static const char *get_many_kwlist[] = {"items", "block", "timeout", NULL};
 static PyObject * EmptyError;
 static PyObject * FullError;
 
+/* Padding between data written by different threads. A full line of
+ * padding separates them no matter how the object itself is aligned.
+ */
+static const size_t CACHE_LINE_SIZE = 64;
+
+/* try_lock attempts before a thread blocks on a contended mutex */
+static const int LOCK_SPIN_COUNT = 128;
+
+/* Slots of an unbounded queue before the first grow */
+static const size_t RING_DEFAULT_CAPACITY = 1024;
+/* Bounded queues allocate all slots up front unless maxsize is bigger */
+static const size_t RING_MAX_PREALLOC = 1 << 16;
+/* Biggest power of two whose slot array size in bytes fits into size_t */
+static const size_t RING_MAX_CAPACITY =
+    (std::numeric_limits<size_t>::max() / sizeof(PyObject*) + 1) / 2;
+
+/* FIFO of PyObject pointers stored in one contiguous array.
+ * The capacity is always a power of two, so the slot of a position is found
+ * by masking instead of a modulo. 'head' and 'tail' are free running
+ * counters, their difference is the number of stored items.
+ * The ring does not touch reference counts, that is up to the caller.
+ * push() only touches 'tail' and pop() only 'head', so a producer and a
+ * consumer can work on it at the same time as long as the caller keeps the
+ * number of items between 0 and capacity().
+ */
+class RingBuffer {
+    private:
+        PyObject **slots;
+        size_t mask;
+        char pad_head[CACHE_LINE_SIZE];
+        size_t head;
+        char pad_tail[CACHE_LINE_SIZE];
+        size_t tail;
+
+    public:
+        RingBuffer(size_t maxsize, bool preallocate);
+        ~RingBuffer(){std::free(this->slots);};
+        size_t size() const {return this->tail - this->head;};
+        size_t capacity() const {return this->mask + 1;};
+        void grow();
+        PyObject* at(size_t i) const {return this->slots[(this->head + i) & this->mask];};
+        void push(PyObject *item);
+        PyObject* pop();
+        void push_many(PyObject **items, size_t nb_of_items);
+        void pop_many(PyObject **items, size_t nb_of_items);
+};
+
+static size_t
+_next_power_of_two(size_t value)
+{
+    size_t result = 1;
+    while (result < value) {
+        result <<= 1;
+    }
+    return result;
+}
+
+static PyObject**
+_alloc_slots(PyObject **slots, size_t capacity)
+{
+    /* The byte count must not wrap around to a tiny allocation */
+    if (capacity > std::numeric_limits<size_t>::max() / sizeof(PyObject*)) {
+        throw std::bad_alloc();
+    }
+
+    void *result = std::realloc(slots, capacity * sizeof(PyObject*));
+    if (result == NULL) {
+        throw std::bad_alloc();
+    }
+    return static_cast<PyObject**>(result);
+}
+
+RingBuffer::RingBuffer(size_t maxsize, bool preallocate)
+{
+    size_t capacity = RING_DEFAULT_CAPACITY;
+    if (maxsize > 0 and (preallocate or maxsize <= RING_MAX_PREALLOC)) {
+        capacity = _next_power_of_two(maxsize);
+    }
+    this->slots = _alloc_slots(NULL, capacity);
+    this->mask = capacity - 1;
+    this->head = 0;
+    this->tail = 0;
+}
+
+void
+RingBuffer::grow()
+{
+    size_t capacity = this->mask + 1;
+    size_t size = this->size();
+    size_t start = this->head & this->mask;
+    size_t wrapped = (start + size > capacity) ? start + size - capacity : 0;
+
+    /* realloc can often extend in place, or remap big blocks without copying */
+    this->slots = _alloc_slots(this->slots, capacity * 2);
+
+    /* Items which wrapped around to the front move behind the old end */
+    std::memcpy(this->slots + capacity, this->slots, wrapped * sizeof(PyObject*));
+
+    this->mask = capacity * 2 - 1;
+    this->head = start;
+    this->tail = start + size;
+}
+
+void
+RingBuffer::push(PyObject *item)
+{
+    this->slots[this->tail & this->mask] = item;
+    this->tail++;
+}
+
+PyObject*
+RingBuffer::pop()
+{
+    PyObject *item = this->slots[this->head & this->mask];
+    this->head++;
+    return item;
+}
+
+/* Copies the items with at most two memcpy calls, one up to the end of the
+ * array and one for the part which wraps around to its start. put_many
+ * waits without the GIL before, so it passes the items of a tuple, the
+ * item array of a list could change meanwhile.
+ */
+void
+RingBuffer::push_many(PyObject **items, size_t nb_of_items)
+{
+    size_t start = this->tail & this->mask;
+    size_t first = std::min(nb_of_items, this->capacity() - start);
+
+    std::memcpy(this->slots + start, items, first * sizeof(PyObject*));
+    std::memcpy(this->slots, items + first, (nb_of_items - first) * sizeof(PyObject*));
+    this->tail += nb_of_items;
+}
+
+void
+RingBuffer::pop_many(PyObject **items, size_t nb_of_items)
+{
+    size_t start = this->head & this->mask;
+    size_t first = std::min(nb_of_items, this->capacity() - start);
+
+    std::memcpy(items, this->slots + start, first * sizeof(PyObject*));
+    std::memcpy(items + first, this->slots, (nb_of_items - first) * sizeof(PyObject*));
+    this->head += nb_of_items;
+}
+
+/* Threads waiting on one side of the queue. Calls for a single item wait on
+ * 'cond', calls for many items on 'many_cond'. Otherwise a get_many still
+ * lacking items could swallow the notify_one meant for a get.
+ * The counters are only changed under the mutex of the side, but the other
+ * side reads them without it, see idle().
+ */
+class Waiters {
+    public:
+        Waiters() : waiting(0), many_waiting(0) {};
+        boost::condition_variable cond;
+        boost::condition_variable many_cond;
+        boost::atomic<size_t> waiting;
+        boost::atomic<size_t> many_waiting;
+        void wait(boost::mutex::scoped_lock& lock, size_t nb_of_items);
+        bool timed_wait(
+                boost::mutex::scoped_lock& lock,
+                size_t nb_of_items,
+                boost::system_time& timeout);
+        bool idle();
+        void notify();
+        void pass_on(size_t available);
+};
+
+/* Counts a thread as waiter for as long as it is in a wait loop. It must be
+ * counted before it checks 'size' for the last time before waiting.
+ * The side which changed 'size' checks idle() afterwards, so either the
+ * waiter sees the new 'size' or the other side sees the waiter.
+ */
+class WaiterCount {
+    public:
+        WaiterCount(Waiters& waiters, size_t nb_of_items) :
+            waiting((nb_of_items == 1) ? waiters.waiting : waiters.many_waiting)
+        {
+            this->waiting++;
+        }
+        ~WaiterCount() {
+            this->waiting--;
+        }
+    private:
+        boost::atomic<size_t>& waiting;
+};
+
+void
+Waiters::wait(boost::mutex::scoped_lock& lock, size_t nb_of_items)
+{
+    boost::condition_variable& cond = (nb_of_items == 1) ? this->cond : this->many_cond;
+    cond.wait(lock);
+}
+
+bool
+Waiters::timed_wait(
+        boost::mutex::scoped_lock& lock,
+        size_t nb_of_items,
+        boost::system_time& timeout)
+{
+    boost::condition_variable& cond = (nb_of_items == 1) ? this->cond : this->many_cond;
+    return cond.timed_wait(lock, timeout);
+}
+
+/* Lets the other side skip taking the mutex of this side to notify nobody */
+bool
+Waiters::idle()
+{
+    return this->waiting.load() == 0 and this->many_waiting.load() == 0;
+}
+
+/* Items (or free slots) became available. Only one single item waiter is
+ * woken, no matter how many items arrived. It wakes the next one with
+ * pass_on() if items are left, and so on. Which many waiters are satisfied
+ * is unknown, so all of them check.
+ */
+void
+Waiters::notify()
+{
+    if (this->waiting) {
+        this->cond.notify_one();
+    }
+
+    if (this->many_waiting) {
+        this->many_cond.notify_all();
+    }
+}
+
+/* Continues the wake up chain of notify() while 'available' is not 0 */
+void
+Waiters::pass_on(size_t available)
+{
+    if (available and this->waiting) {
+        this->cond.notify_one();
+    }
+}
+
+/* put and get calls lock different mutexes, so producers and consumers do
+ * not contend with each other. They only meet at the atomic 'size', which
+ * is the number of items visible to the get side. Growing the ring moves
+ * items under the get side, so it is done holding both mutexes.
+ * Lock order is put_mutex before get_mutex.
+ * The members used by producers, by consumers and by both are padded
+ * apart, so a put does not invalidate the cache lines of a running get.
+ */
 class Bridge {
     public:
-        boost::mutex mutex;
-        boost::condition_variable empty_cond;
-        boost::condition_variable full_cond;
+        Bridge(size_t maxsize, bool spsc) : queue(maxsize, spsc), size(0), unfinished_tasks(0) {};
+        RingBuffer queue;
+        char pad_put[CACHE_LINE_SIZE];
+        /* Guards the tail of the ring and full_waiters */
+        boost::mutex put_mutex;
+        Waiters full_waiters;
+        char pad_get[CACHE_LINE_SIZE];
+        /* Guards the head of the ring and empty_waiters */
+        boost::mutex get_mutex;
+        Waiters empty_waiters;
+        char pad_size[CACHE_LINE_SIZE];
+        boost::atomic<size_t> size;
+        char pad_tasks[CACHE_LINE_SIZE];
+        boost::mutex tasks_mutex;
         boost::condition_variable all_tasks_done_cond;
-        std::deque<PyObject*> queue;
+        boost::atomic<boost::uint64_t> unfinished_tasks;
 };
 
 typedef struct {
     PyObject_HEAD
     Bridge *bridge;
     size_t maxsize;
-    boost::uint64_t unfinished_tasks;
+    /* Only one thread puts and only one thread gets */
+    bool spsc;
 } Queue;
 
 
@@ -73,8 +337,8 @@ Queue_new(PyTypeObject *type, PyObject *args, PyObject *kwargs)
     Queue *self;
     self = reinterpret_cast<Queue*> (type->tp_alloc(type, 0));
     self->bridge = NULL;
-    self->unfinished_tasks = 0;
     self->maxsize = 0;
+    self->spsc = false;
 
     return reinterpret_cast<PyObject*>(self);
 }
@@ -82,9 +346,39 @@ Queue_new(PyTypeObject *type, PyObject *args, PyObject *kwargs)
 static int
 Queue_init(Queue *self, PyObject *args, PyObject *kwargs)
 {
-    long int maxsize=0;
-    if(!PyArg_ParseTuple(args, "|l", &maxsize))
+    PyObject *py_maxsize=NULL;
+    PyObject *py_spsc=NULL;
+    PY_LONG_LONG maxsize=0;
+    int overflow=0;
+
+    if(!PyArg_ParseTupleAndKeywords(
+                                args,
+                                kwargs,
+                                "|OO:Queue",
+                                const_cast<char**>(init_kwlist),
+                                &py_maxsize,
+                                &py_spsc))
+    {
         return -1;
+    }
+
+    if (py_maxsize != NULL) {
+        /* Would be truncated by __int__, like "l" refuses to do */
+        if (PyFloat_Check(py_maxsize)) {
+            PyErr_Format(PyExc_TypeError, "'maxsize' must be an integer");
+            return -1;
+        }
+
+        /* Reports an overflow by flag, no exception to set up and clear */
+        maxsize = PyLong_AsLongLongAndOverflow(py_maxsize, &overflow);
+        if (overflow) {
+            PyErr_Format(PyExc_OverflowError, "'maxsize' is too large");
+            return -1;
+        }
+        if (maxsize == -1 and PyErr_Occurred()) {
+            return -1;
+        }
+    }
 
     if (maxsize < 0) {
         self->maxsize = 0;
@@ -93,8 +387,22 @@ Queue_init(Queue *self, PyObject *args, PyObject *kwargs)
         self->maxsize = maxsize;
     }
 
+    if (py_spsc != NULL and PyObject_IsTrue(py_spsc)) {
+        if (self->maxsize == 0) {
+            PyErr_Format(PyExc_ValueError, "a spsc queue needs a maxsize");
+            return -1;
+        }
+        self->spsc = true;
+    }
+
+    /* spsc queues allocate all slots up front, see RingBuffer */
+    if (self->spsc and self->maxsize > RING_MAX_CAPACITY) {
+        PyErr_Format(PyExc_OverflowError, "'maxsize' is too large for a spsc queue");
+        return -1;
+    }
+
     BEGIN_SAFE_CALL
-        self->bridge = new Bridge();
+        self->bridge = new Bridge(self->maxsize, self->spsc);
     END_SAFE_CALL("Error creating underlying queue: %s", -1)
     return 0;
 }
@@ -103,8 +411,8 @@ static int
 Queue_traverse(Queue *self, visitproc visit, void *arg)
 {
     BEGIN_SAFE_CALL
-        BOOST_FOREACH(PyObject* entry, self->bridge->queue) {
-            Py_VISIT(entry);
+        for (size_t i=0; i < self->bridge->queue.size(); i++) {
+            Py_VISIT(self->bridge->queue.at(i));
         }
     END_SAFE_CALL("Error while traversing: %s", -1)
     return 0;
@@ -114,9 +422,11 @@ static int
 Queue_clear(Queue *self)
 {
     BEGIN_SAFE_CALL
-        BOOST_FOREACH(PyObject* entry, self->bridge->queue) {
-            Py_CLEAR(entry);
+        while (self->bridge->queue.size()) {
+            PyObject *entry = self->bridge->queue.pop();
+            Py_DECREF(entry);
         }
+        self->bridge->size.store(0, boost::memory_order_relaxed);
     END_SAFE_CALL("Error while clear: %s", -1)
     return 0;
 }
@@ -150,10 +460,19 @@ _parse_block_and_timeout(
      * timeout == 0 => block = false
      */
     if (py_timeout != NULL and py_timeout != Py_None) {
-        timeout = PyFloat_AsDouble(py_timeout);
-        if (PyErr_Occurred()) {
-            PyErr_Format(PyExc_ValueError, "'timeout' is not a valid float");
-            return -1;
+        /* Exact floats and ints can not fail, skip the error check for them */
+        if (PyFloat_CheckExact(py_timeout)) {
+            timeout = PyFloat_AS_DOUBLE(py_timeout);
+        }
+        else if (PyInt_CheckExact(py_timeout)) {
+            timeout = static_cast<double>(PyInt_AS_LONG(py_timeout));
+        }
+        else {
+            timeout = PyFloat_AsDouble(py_timeout);
+            if (PyErr_Occurred()) {
+                PyErr_Format(PyExc_ValueError, "'timeout' is not a valid float");
+                return -1;
+            }
         }
 
         if (timeout < 0) {
@@ -173,28 +492,90 @@ _parse_block_and_timeout(
     return 1;
 }
 
+/* Give the CPU a hint that this is a spin loop */
+static inline void
+_cpu_relax()
+{
+#if defined(__GNUC__) && (defined(__i386__) || defined(__x86_64__))
+    __asm__ __volatile__("pause");
+#endif
+}
+
+/* The mutexes are only held for a few pointer moves. So spin on try_lock
+ * for a short while before sleeping in the kernel. The GIL is released
+ * first, the owner of the mutex might need it to make progress.
+ */
 static void
 _wait_for_lock(boost::mutex::scoped_lock& lock)
 {
     AllowThreads raii_lock;
+    for (int i=0; i < LOCK_SPIN_COUNT; i++) {
+        _cpu_relax();
+        if (lock.try_lock()) {
+            return;
+        }
+    }
     lock.lock();
 }
 
+/* Waiters check 'size' holding the mutex of their side. Taking that mutex
+ * before notifying makes sure the notification does not get lost between
+ * their check and their wait. Without waiters the mutex is not touched,
+ * so a put does not contend with a running get just to notify nobody.
+ */
+static void
+_notify_waiters(boost::mutex& mutex, Waiters& waiters)
+{
+    if (waiters.idle()) {
+        return;
+    }
+
+    boost::mutex::scoped_lock lock(mutex, boost::try_to_lock);
+    if (not lock.owns_lock()) {
+        _wait_for_lock(lock);
+    }
+    waiters.notify();
+}
+
+/* Grow the ring until 'nb_of_items' more items fit. The caller holds
+ * put_mutex and has already waited for enough free slots of maxsize.
+ */
+static void
+_reserve_slots(Bridge* bridge, size_t nb_of_items)
+{
+    if ((bridge->queue.capacity() - bridge->size.load()) >= nb_of_items) {
+        return;
+    }
+
+    boost::mutex::scoped_lock lock(bridge->get_mutex, boost::try_to_lock);
+    if (not lock.owns_lock()) {
+        _wait_for_lock(lock);
+    }
+
+    while ((bridge->queue.capacity() - bridge->size.load()) < nb_of_items) {
+        bridge->queue.grow();
+    }
+}
+
 static void
-_blocked_wait_full(Bridge* bridge, boost::mutex::scoped_lock& lock)
+_blocked_wait_full(
+        Bridge* bridge,
+        boost::mutex::scoped_lock& lock,
+        size_t nb_of_items)
 {
     AllowThreads raii_lock;
-    bridge->full_cond.wait(lock);
+    bridge->full_waiters.wait(lock, nb_of_items);
 }
 
 static bool
 _timed_wait_full(
         Bridge* bridge,
         boost::mutex::scoped_lock& lock,
+        size_t nb_of_items,
         boost::system_time& timeout)
 {
     AllowThreads raii_lock;
-    return bridge->full_cond.timed_wait(lock, timeout);
+    return bridge->full_waiters.timed_wait(lock, nb_of_items, timeout);
 }
 
 static bool
@@ -210,7 +591,7 @@ _wait_for_free_slots(
     if(self->maxsize == 0) {
         /* Fall through the end of method */
     }
-    else if((self->maxsize - self->bridge->queue.size()) >= nb_of_items) {
+    else if((self->maxsize - self->bridge->size.load()) >= nb_of_items) {
         /* Fall through the end of method */
     }
     else if (not block) {
@@ -218,80 +599,122 @@ _wait_for_free_slots(
         return false;
     }
     else if (timeout > 0) {
+        WaiterCount count(self->bridge->full_waiters, nb_of_items);
         boost::system_time abs_timeout = boost::get_system_time();
         abs_timeout += boost::posix_time::milliseconds(timeout_millis);
-        while (!((self->maxsize - self->bridge->queue.size()) >= nb_of_items)) {
-            if (not _timed_wait_full(self->bridge, lock, abs_timeout)) {
+        while (!((self->maxsize - self->bridge->size.load()) >= nb_of_items)) {
+            if (not _timed_wait_full(self->bridge, lock, nb_of_items, abs_timeout)
+                    and !((self->maxsize - self->bridge->size.load()) >= nb_of_items))
+            {
                 PyErr_Format(FullError, "Queue Full");
                 return false;
             }
         }
     }
     else {
-        while (!((self->maxsize - self->bridge->queue.size()) >= nb_of_items)) {
-            _blocked_wait_full(self->bridge, lock);
+        WaiterCount count(self->bridge->full_waiters, nb_of_items);
+        while (!((self->maxsize - self->bridge->size.load()) >= nb_of_items)) {
+            _blocked_wait_full(self->bridge, lock, nb_of_items);
         }
     }
     return true;
 }
 
-static PyObject*
-_internal_put(Queue *self, PyObject *item, bool block, double timeout)
+/* Lock free pre check for non blocking puts. 'size' may be outdated, but
+ * if it says there is no room, raising Full without the mutex is fine.
+ */
+static bool
+_lacks_free_slots(
+        Queue *self,
+        size_t nb_of_items,
+        boost::memory_order order=boost::memory_order_relaxed)
+{
+    if (self->maxsize == 0) {
+        return false;
+    }
+    size_t size = self->bridge->size.load(order);
+    return (self->maxsize - size) < nb_of_items;
+}
+
+/* A spsc queue has no other thread on the same side to exclude, so the
+ * mutex of the side is only needed to wait. The acquire load of 'size'
+ * pairs with its update by the other side, which hands over the slots.
+ */
+static bool
+_must_lock_put_side(Queue *self, size_t nb_of_items)
+{
+    return not self->spsc or _lacks_free_slots(self, nb_of_items, boost::memory_order_acquire);
+}
+
+/* Moves 'nb_of_items' references into the queue. The caller owns them and
+ * gets them back if -1 is returned.
+ */
+static int
+_push_items(
+        Queue *self,
+        PyObject **items,
+        size_t nb_of_items,
+        bool block,
+        double timeout)
 {
     BEGIN_SAFE_CALL
 
-    boost::mutex::scoped_lock lock(self->bridge->mutex, boost::try_to_lock);
-    if (not lock.owns_lock()) {
-        _wait_for_lock(lock);
+    boost::mutex::scoped_lock lock(self->bridge->put_mutex, boost::defer_lock);
+    if (_must_lock_put_side(self, nb_of_items)) {
+        if (not lock.try_lock()) {
+            _wait_for_lock(lock);
+        }
+
+        if (not _wait_for_free_slots(self, block, timeout, lock, nb_of_items)) {
+            return -1;
+        }
     }
 
-    if (not _wait_for_free_slots(self, block, timeout, lock, 1)) {
-        return NULL;
+    _reserve_slots(self->bridge, nb_of_items);
+    if (nb_of_items == 1) {
+        self->bridge->queue.push(items[0]);
+    }
+    else {
+        self->bridge->queue.push_many(items, nb_of_items);
     }
 
-    self->bridge->queue.push_back(item);
-    Py_INCREF(item);
+    /* Publish all items at once, get_many sees none or all of them */
+    self->bridge->unfinished_tasks += nb_of_items;
+    size_t size = (self->bridge->size += nb_of_items);
+    if (lock.owns_lock()) {
+        if (self->maxsize > 0) {
+            self->bridge->full_waiters.pass_on(self->maxsize - size);
+        }
+        lock.unlock();
+    }
 
-    self->unfinished_tasks += 1;
-    self->bridge->empty_cond.notify_one();
+    _notify_waiters(self->bridge->get_mutex, self->bridge->empty_waiters);
 
-    END_SAFE_CALL("Error in put: %s", NULL)
-    Py_RETURN_NONE;
+    END_SAFE_CALL("Error in put: %s", -1)
+    return 0;
 }
 
 static PyObject*
-Queue_put(Queue *self, PyObject *args, PyObject *kwargs)
+_internal_put(Queue *self, PyObject *item, bool block, double timeout)
 {
-    PyObject *item;
-
-    PyObject *py_block=NULL;
-    bool block=true;
-
-    PyObject *py_timeout=NULL;
-    double timeout = 0;
-    
-    if (not PyArg_ParseTupleAndKeywords(
-                                args,
-                                kwargs,
-                                "O|OO:put",
-                                const_cast<char**>(put_kwlist),
-                                &item,
-                                &py_block,
-                                &py_timeout))
-    {
+    if (not block and _lacks_free_slots(self, 1)) {
+        PyErr_Format(FullError, "Queue Full");
         return NULL;
     }
 
-    if (_parse_block_and_timeout(py_block, py_timeout, block, timeout) == -1) {
+    /* Reference counting stays out of the critical section */
+    Py_INCREF(item);
+    if (_push_items(self, &item, 1, block, timeout) == -1) {
+        Py_DECREF(item);
         return NULL;
     }
-    return _internal_put(self, item, block, timeout);
+    Py_RETURN_NONE;
 }
 
 static PyObject*
-Queue_put_many(Queue *self, PyObject *args, PyObject *kwargs)
+Queue_put(Queue *self, PyObject *args, PyObject *kwargs)
 {
-    PyObject *items;
+    PyObject *item;
 
     PyObject *py_block=NULL;
     bool block=true;
@@ -299,16 +722,26 @@ Queue_put_many(Queue *self, PyObject *args, PyObject *kwargs)
     PyObject *py_timeout=NULL;
     double timeout = 0;
 
-    PyObject *iterator=NULL;
-    PyObject *itertor_item=NULL;
-    Py_ssize_t items_len;
+    Py_ssize_t nargs = PyTuple_GET_SIZE(args);
 
-    if (not PyArg_ParseTupleAndKeywords(
+    /* Positional calls are the common case and do not need the generic
+     * (and slow) format string parser.
+     */
+    if (kwargs == NULL and nargs >= 1 and nargs <= 3) {
+        item = PyTuple_GET_ITEM(args, 0);
+        if (nargs > 1) {
+            py_block = PyTuple_GET_ITEM(args, 1);
+        }
+        if (nargs > 2) {
+            py_timeout = PyTuple_GET_ITEM(args, 2);
+        }
+    }
+    else if (not PyArg_ParseTupleAndKeywords(
                                 args,
                                 kwargs,
                                 "O|OO:put",
-                                const_cast<char**>(put_many_kwlist),
-                                &items,
+                                const_cast<char**>(put_kwlist),
+                                &item,
                                 &py_block,
                                 &py_timeout))
     {
@@ -318,23 +751,22 @@ Queue_put_many(Queue *self, PyObject *args, PyObject *kwargs)
     if (_parse_block_and_timeout(py_block, py_timeout, block, timeout) == -1) {
         return NULL;
     }
+    return _internal_put(self, item, block, timeout);
+}
 
-    if ((items_len = PyObject_Length(items)) == -1) {
-        return NULL;
-    }
+/* 'items_tuple' cannot change while _push_items waits without the GIL, so
+ * the references taken here are the ones queued or given back on failure.
+ */
+static PyObject*
+_internal_put_many(Queue *self, PyObject *items_tuple, bool block, double timeout)
+{
+    Py_ssize_t items_len = PyTuple_GET_SIZE(items_tuple);
+    PyObject **items_array = &PyTuple_GET_ITEM(items_tuple, 0);
 
     if (items_len == 0) {
         Py_RETURN_NONE;
     }
 
-    /* Can happen if items is a custom object overloading __len__ */
-    if (items_len < 0) {
-        return PyErr_Format(
-                PyExc_ValueError,
-                "len of items is smaller 0: %i",
-                items_len);
-    }
-
     if (self->maxsize > 0 and static_cast<size_t>(items_len) > self->maxsize) {
         return PyErr_Format(
                     PyExc_ValueError,
@@ -343,52 +775,85 @@ Queue_put_many(Queue *self, PyObject *args, PyObject *kwargs)
                     self->maxsize);
     }
 
-    BEGIN_SAFE_CALL
+    if (not block and _lacks_free_slots(self, static_cast<size_t>(items_len))) {
+        PyErr_Format(FullError, "Queue Full");
+        return NULL;
+    }
 
-    boost::mutex::scoped_lock lock(self->bridge->mutex, boost::try_to_lock);
-    if (not lock.owns_lock()) {
-        _wait_for_lock(lock);
+    for (Py_ssize_t i=0; i<items_len; i++) {
+        Py_INCREF(items_array[i]);
     }
 
-    if (not _wait_for_free_slots(self, block, timeout, lock, static_cast<size_t>(items_len))) {
+    if (_push_items(self, items_array, static_cast<size_t>(items_len), block, timeout) == -1) {
+        for (Py_ssize_t i=0; i<items_len; i++) {
+            Py_DECREF(items_array[i]);
+        }
         return NULL;
     }
+    Py_RETURN_NONE;
+}
+
+static PyObject*
+Queue_put_many(Queue *self, PyObject *args, PyObject *kwargs)
+{
+    PyObject *items;
+    PyObject *items_tuple;
+    PyObject *result;
+
+    PyObject *py_block=NULL;
+    bool block=true;
+
+    PyObject *py_timeout=NULL;
+    double timeout = 0;
 
-    if ((iterator = PyObject_GetIter(items)) == NULL) {
+    if (not PyArg_ParseTupleAndKeywords(
+                                args,
+                                kwargs,
+                                "O|OO:put",
+                                const_cast<char**>(put_many_kwlist),
+                                &items,
+                                &py_block,
+                                &py_timeout))
+    {
         return NULL;
     }
 
-    while ((itertor_item = PyIter_Next(iterator))) {
-        self->bridge->queue.push_back(itertor_item);
-        self->unfinished_tasks += 1;
-
+    if (_parse_block_and_timeout(py_block, py_timeout, block, timeout) == -1) {
+        return NULL;
     }
-    self->bridge->empty_cond.notify_all();
-    Py_DECREF(iterator);
 
-    if (PyErr_Occurred()) {
+    /* The GIL is released while waiting, so another thread could change a
+     * list meanwhile. Tuples are used as they are, everything else is
+     * copied into one before any mutex is taken.
+     */
+    if ((items_tuple = PySequence_Tuple(items)) == NULL) {
         return NULL;
     }
 
-    END_SAFE_CALL("Error in put_many: %s", NULL)
-    Py_RETURN_NONE;
+    result = _internal_put_many(self, items_tuple, block, timeout);
+    Py_DECREF(items_tuple);
+    return result;
 }
 
 static void
-_blocked_wait_empty(Bridge* bridge, boost::mutex::scoped_lock& lock)
+_blocked_wait_empty(
+        Bridge* bridge,
+        boost::mutex::scoped_lock& lock,
+        size_t nb_of_items)
 {
     AllowThreads raii_lock;
-    bridge->empty_cond.wait(lock);
+    bridge->empty_waiters.wait(lock, nb_of_items);
 }
 
 static bool
 _timed_wait_empty(
         Bridge* bridge,
         boost::mutex::scoped_lock& lock,
+        size_t nb_of_items,
         boost::system_time& timeout)
 {
     AllowThreads raii_lock;
-    return bridge->empty_cond.timed_wait(lock, timeout);
+    return bridge->empty_waiters.timed_wait(lock, nb_of_items, timeout);
 }
 
 static bool
@@ -397,11 +862,11 @@ _wait_for_items(
         bool block,
         double timeout,
         boost::mutex::scoped_lock& lock,
-        long int items_len)
+        size_t nb_of_items)
 {
     boost::uint64_t timeout_millis = static_cast<boost::uint64_t>(timeout*1000);
 
-    if (self->bridge->queue.size() >= static_cast<size_t>(items_len)) {
+    if (self->bridge->size.load() >= nb_of_items) {
         /* Fall through the end of method */
     }
     else if (not block) {
@@ -409,43 +874,101 @@ _wait_for_items(
         return false;
     }
     else if (timeout > 0) {
+        WaiterCount count(self->bridge->empty_waiters, nb_of_items);
         boost::system_time abs_timeout = boost::get_system_time();
         abs_timeout += boost::posix_time::milliseconds(timeout_millis);
-        while (self->bridge->queue.size() < items_len) {
-            if (not _timed_wait_empty(self->bridge, lock, abs_timeout)) {
+        while (self->bridge->size.load() < nb_of_items) {
+            if (not _timed_wait_empty(self->bridge, lock, nb_of_items, abs_timeout)
+                    and self->bridge->size.load() < nb_of_items)
+            {
                 PyErr_Format(EmptyError, "Queue Empty");
                 return false;
             }
         }
     }
     else {
-        while (not (self->bridge->queue.size() >= static_cast<size_t>(items_len))) {
-            _blocked_wait_empty(self->bridge, lock);
+        WaiterCount count(self->bridge->empty_waiters, nb_of_items);
+        while (not (self->bridge->size.load() >= nb_of_items)) {
+            _blocked_wait_empty(self->bridge, lock, nb_of_items);
         }
     }
     return true;
 }
 
-static PyObject*
-_internal_get(Queue *self, bool block, double timeout)
+/* Lock free pre check for non blocking gets, see _lacks_free_slots */
+static bool
+_lacks_items(
+        Queue *self,
+        size_t nb_of_items,
+        boost::memory_order order=boost::memory_order_relaxed)
+{
+    return self->bridge->size.load(order) < nb_of_items;
+}
+
+/* See _must_lock_put_side */
+static bool
+_must_lock_get_side(Queue *self, size_t nb_of_items)
+{
+    return not self->spsc or _lacks_items(self, nb_of_items, boost::memory_order_acquire);
+}
+
+/* Moves 'nb_of_items' references out of the queue into 'items', the
+ * caller owns them afterwards.
+ */
+static int
+_pop_items(
+        Queue *self,
+        PyObject **items,
+        size_t nb_of_items,
+        bool block,
+        double timeout)
 {
     BEGIN_SAFE_CALL
 
-    boost::mutex::scoped_lock lock(self->bridge->mutex, boost::try_to_lock);
-    if (not lock.owns_lock()) {
-        _wait_for_lock(lock);
+    boost::mutex::scoped_lock lock(self->bridge->get_mutex, boost::defer_lock);
+    if (_must_lock_get_side(self, nb_of_items)) {
+        if (not lock.try_lock()) {
+            _wait_for_lock(lock);
+        }
+
+        if (not _wait_for_items(self, block, timeout, lock, nb_of_items)) {
+            return -1;
+        }
     }
 
-    if (not _wait_for_items(self, block, timeout, lock, 1)) {
+    if (nb_of_items == 1) {
+        items[0] = self->bridge->queue.pop();
+    }
+    else {
+        self->bridge->queue.pop_many(items, nb_of_items);
+    }
+
+    size_t size = (self->bridge->size -= nb_of_items);
+    if (lock.owns_lock()) {
+        self->bridge->empty_waiters.pass_on(size);
+        lock.unlock();
+    }
+
+    _notify_waiters(self->bridge->put_mutex, self->bridge->full_waiters);
+
+    END_SAFE_CALL("Error in get: %s", -1)
+    return 0;
+}
+
+static PyObject*
+_internal_get(Queue *self, bool block, double timeout)
+{
+    PyObject *item;
+
+    if (not block and _lacks_items(self, 1)) {
+        PyErr_Format(EmptyError, "Queue Empty");
         return NULL;
     }
 
-    PyObject *item = self->bridge->queue.front();
-    self->bridge->queue.pop_front();
-    self->bridge->full_cond.notify_one();
+    if (_pop_items(self, &item, 1, block, timeout) == -1) {
+        return NULL;
+    }
     return item;
-
-    END_SAFE_CALL("Error in get: %s", NULL)
 }
 
 static PyObject*
@@ -457,8 +980,19 @@ Queue_get(Queue *self, PyObject *args, PyObject *kwargs)
 
     bool block=true;
     double timeout = 0;
-    
-    if(not PyArg_ParseTupleAndKeywords(
+
+    Py_ssize_t nargs = PyTuple_GET_SIZE(args);
+
+    /* See Queue_put */
+    if (kwargs == NULL and nargs <= 2) {
+        if (nargs > 0) {
+            py_block = PyTuple_GET_ITEM(args, 0);
+        }
+        if (nargs > 1) {
+            py_timeout = PyTuple_GET_ITEM(args, 1);
+        }
+    }
+    else if(not PyArg_ParseTupleAndKeywords(
                                 args,
                                 kwargs,
                                 "|OO:get",
@@ -523,45 +1057,42 @@ Queue_get_many(Queue *self, PyObject *args, PyObject *kwargs)
                 self->maxsize);
     }
 
-    BEGIN_SAFE_CALL
-
-    boost::mutex::scoped_lock lock(self->bridge->mutex, boost::try_to_lock);
-    if (not lock.owns_lock()) {
-        _wait_for_lock(lock);
-    }
-
-    if (not _wait_for_items(self, block, timeout, lock, items)) {
+    if (not block and _lacks_items(self, static_cast<size_t>(items))) {
+        PyErr_Format(EmptyError, "Queue Empty");
         return NULL;
     }
 
+    /* Allocated before any mutex is taken. The references move from the
+     * ring into the tuple as they are, no incref/decref needed.
+     */
     if ((result_tuple = PyTuple_New(items)) == NULL) {
         return NULL;
     }
 
-    for (long int i=0; i<items; i++) {
-        PyObject *item = self->bridge->queue.front();
-        PyTuple_SET_ITEM(result_tuple, i, item);
-
-        self->bridge->queue.pop_front();
+    if (_pop_items(
+                self,
+                &PyTuple_GET_ITEM(result_tuple, 0),
+                static_cast<size_t>(items),
+                block,
+                timeout) == -1)
+    {
+        Py_DECREF(result_tuple);
+        return NULL;
     }
-
-    self->bridge->full_cond.notify_all();
     return result_tuple;
-
-
-    END_SAFE_CALL("Error in get_many: %s", NULL)
 }
 
+/* qsize, empty and full are snapshots anyway, a relaxed load is enough */
 static PyObject*
 Queue_qsize(Queue *self)
 {
-    return PyLong_FromSize_t(self->bridge->queue.size());
+    return PyLong_FromSize_t(self->bridge->size.load(boost::memory_order_relaxed));
 }
 
 static PyObject*
 Queue_empty(Queue *self)
 {
-    if (self->bridge->queue.size() == 0) {
+    if (self->bridge->size.load(boost::memory_order_relaxed) == 0) {
         Py_RETURN_TRUE;
     }
     Py_RETURN_FALSE;
@@ -574,7 +1105,7 @@ Queue_full(Queue *self)
         Py_RETURN_FALSE;
     }
 
-    if (self->bridge->queue.size() < self->maxsize) {
+    if (self->bridge->size.load(boost::memory_order_relaxed) < self->maxsize) {
         Py_RETURN_FALSE;
     }
     Py_RETURN_TRUE;
@@ -597,17 +1128,17 @@ Queue_task_done(Queue *self)
 {
     BEGIN_SAFE_CALL
 
-    boost::mutex::scoped_lock lock(self->bridge->mutex, boost::try_to_lock);
+    boost::mutex::scoped_lock lock(self->bridge->tasks_mutex, boost::try_to_lock);
     if (not lock.owns_lock()) {
         _wait_for_lock(lock);
     }
 
-    if (self->unfinished_tasks == 0) {
+    if (self->bridge->unfinished_tasks.load() == 0) {
         return PyErr_Format(
                     PyExc_ValueError, "task_done() called too many times");
     }
 
-    if (--self->unfinished_tasks == 0) {
+    if (--self->bridge->unfinished_tasks == 0) {
         self->bridge->all_tasks_done_cond.notify_all();
     }
 
@@ -627,12 +1158,12 @@ Queue_join(Queue* self)
 {
     BEGIN_SAFE_CALL
 
-    boost::mutex::scoped_lock lock(self->bridge->mutex, boost::try_to_lock);
+    boost::mutex::scoped_lock lock(self->bridge->tasks_mutex, boost::try_to_lock);
     if (not lock.owns_lock()) {
         _wait_for_lock(lock);
     }
 
-    while (self->unfinished_tasks) {
+    while (self->bridge->unfinished_tasks.load()) {
         _blocked_wait_all_tasks_done(self, lock);
     }
 
@@ -10,6 +10,7 @@
 
 #include <deque>
 #include <exception>
+#include <boost/atomic.hpp>
 #include <boost/date_time/posix_time/posix_time_types.hpp>
 #include <boost/thread/condition_variable.hpp>
 #include <boost/thread/mutex.hpp>
@@ -24,6 +25,8 @@ class ConcurrentQueue {
     private:
         boost::mutex mutex;
         std::deque<T> queue;
+        /* queue.size() for readers not holding the mutex */
+        boost::atomic<size_t> queue_size;
         boost::condition_variable empty_cond;
         boost::condition_variable full_cond;
         boost::condition_variable all_tasks_done_cond;
@@ -53,14 +56,14 @@ ConcurrentQueue<T>::ConcurrentQueue(long maxsize)
         this->maxsize = maxsize;
     }
     this->unfinished_tasks = 0;
+    this->queue_size.store(0, boost::memory_order_relaxed);
 }
 
 template<typename T>
 size_t
 ConcurrentQueue<T>::size()
 {
-    boost::lock_guard<boost::mutex> raii_lock(this->mutex);
-    return this->queue.size();
+    return this->queue_size.load(boost::memory_order_relaxed);
 }
 
 template<typename T>
@@ -93,6 +96,7 @@ ConcurrentQueue<T>::put(T &item, bool block, boost::uint64_t timeout)
     }
 
     this->queue.push_back(item);
+    this->queue_size.fetch_add(1, boost::memory_order_relaxed);
     this->unfinished_tasks += 1;
     lock.unlock();
     this->empty_cond.notify_one();
@@ -128,6 +132,7 @@ ConcurrentQueue<T>::pop(T & item, bool block, boost::uint64_t timeout)
 
     item = this->queue.front();
     this->queue.pop_front();
+    this->queue_size.fetch_sub(1, boost::memory_order_relaxed);
     lock.unlock();
     this->full_cond.notify_one();
 }
@@ -1,11 +1,26 @@
+import os
+import sys
 from setuptools import setup
 from setuptools import Extension
 
+compile_args = ["-O3"]
+link_args = []
+
+# Link time optimization and GNU ld options, the macOS linker lacks them
+if sys.platform.startswith('linux'):
+    compile_args += ["-flto", "-fno-plt"]
+    link_args += ["-flto", "-Wl,--as-needed"]
+
+# Tune for the building CPU, the result may not run on other machines
+if os.environ.get('BOOST_QUEUE_NATIVE') == '1':
+    compile_args.append("-march=native")
+
 mod = Extension(
         'boost_queue',
         sources=['boost_queue.cpp'],
         libraries=['boost_thread', 'boost_date_time'],
-        extra_compile_args=["-O2"],
+        extra_compile_args=compile_args,
+        extra_link_args=link_args,
         )
 
 setup(
@@ -13,6 +13,16 @@ import threading
 # 2 => 45.24
 # 3 => 76.62
 
+## boost_queue with CHUNK = 100 (nb_threads, seconds)
+## measured on another machine, CHUNK = 1 took 2.04, 2.65 and 3.27 there
+# 1 => 0.58
+# 2 => 1.17
+# 3 => 2.09
+
+# Items per put_many/get_many call, 1 uses plain put/get. The Queue of
+# the stdlib has no put_many/get_many, so it needs 1.
+CHUNK = 1
+
 class BigFatObject(object):
     def __init__(self):
         self.a = 'adsfadsfadfs'
@@ -25,8 +35,12 @@ class Con(threading.Thread):
         threading.Thread.__init__(self)
 
     def run(self):
-        for _ in xrange(10**6):
-            self.q.get()
+        if CHUNK == 1:
+            for _ in xrange(10**6):
+                self.q.get()
+        else:
+            for _ in xrange(10**6 / CHUNK):
+                self.q.get_many(CHUNK)
 
 class Prod(threading.Thread):
     def __init__(self, q):
@@ -34,8 +48,12 @@ class Prod(threading.Thread):
         threading.Thread.__init__(self)
 
     def run(self):
-        for _ in xrange(10**6):
-            self.q.put(BigFatObject())
+        if CHUNK == 1:
+            for _ in xrange(10**6):
+                self.q.put(BigFatObject())
+        else:
+            for _ in xrange(10**6 / CHUNK):
+                self.q.put_many(tuple(BigFatObject() for _ in xrange(CHUNK)))
 
 if __name__ == '__main__':
     q = Queue()
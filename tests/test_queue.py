@@ -1,4 +1,5 @@
 import time
+import sys
 import threading
 from unittest2 import TestCase
 
@@ -89,6 +90,17 @@ class TestQueue(TestCase):
         q = Queue(-1000)
         self.assertEqual(q.maxsize, 0)
 
+    def test_integer_like_max_size(self):
+        class Three(object):
+            def __int__(self):
+                return 3
+
+        self.assertEqual(Queue(Three()).maxsize, 3)
+        with self.assertRaises(TypeError):
+            Queue(3.0)
+        with self.assertRaises(TypeError):
+            Queue('3')
+
     def test_maxsize_get(self):
         q = Queue(100)
         self.assertEqual(q.maxsize, 100)
@@ -162,3 +174,149 @@ class TestQueue(TestCase):
 
         with self.assertRaises(Empty):
             q.get_many(2, block=False)
+
+    def test_unbounded_queue_keeps_order_while_growing(self):
+        q = Queue()
+        for x in range(1000):
+            q.put(x)
+        self.assertEqual(tuple(range(500)), q.get_many(500))
+
+        # wrap around the end of the underlying storage and grow it
+        q.put_many(range(1000, 3000))
+        self.assertEqual(2500, q.qsize())
+        self.assertEqual(tuple(range(500, 3000)), q.get_many(2500))
+        self.assertTrue(q.empty())
+
+    def test_put_many_with_generator(self):
+        q = Queue(10)
+        q.put_many(x * 2 for x in range(3))
+        self.assertEqual((0, 2, 4), q.get_many(3))
+
+    def test_put_many_ignores_list_changes_while_waiting(self):
+        q = Queue(2)
+        q.put(0)
+        a, b, x, y = object(), object(), object(), object()
+        items = [a, b]
+        putter = threading.Thread(target=q.put_many, args=(items,))
+        putter.start()
+        time.sleep(0.1)
+        items[0] = x
+        items[1] = y
+        items.extend(range(100))
+
+        self.assertEqual(0, q.get())
+        putter.join()
+        self.assertEqual((a, b), q.get_many(2))
+        del items
+        self.assertEqual(2, sys.getrefcount(a))
+        self.assertEqual(2, sys.getrefcount(b))
+        self.assertEqual(2, sys.getrefcount(x))
+        self.assertEqual(2, sys.getrefcount(y))
+
+    def test_put_many_timeout_gives_references_back(self):
+        q = Queue(2)
+        q.put(0)
+        a, b = object(), object()
+        with self.assertRaises(Full):
+            q.put_many([a, b], True, 0.1)
+        self.assertEqual(2, sys.getrefcount(a))
+        self.assertEqual(2, sys.getrefcount(b))
+
+    def test_waiting_get_many_does_not_swallow_wakeup_of_get(self):
+        q = Queue()
+        got = []
+        got_many = []
+
+        many = threading.Thread(target=lambda: got_many.append(q.get_many(3)))
+        many.start()
+        time.sleep(0.1)
+        single = threading.Thread(target=lambda: got.append(q.get(True, 5)))
+        single.start()
+        time.sleep(0.1)
+
+        start = time.time()
+        q.put(1)
+        single.join()
+        self.assertEqual([1], got)
+        self.assertLess(time.time() - start, 4)
+
+        q.put_many((2, 3, 4))
+        many.join()
+        self.assertEqual([(2, 3, 4)], got_many)
+
+    def test_waiting_calls_release_the_gil(self):
+        # Each waiting call would hang the main thread if it kept the GIL
+        q = Queue(1)
+        getter = threading.Thread(target=q.get)
+        getter.start()
+        time.sleep(0.1)
+        q.put(1)
+        getter.join()
+
+        q.put(2)
+        putter = threading.Thread(target=q.put, args=(3,))
+        putter.start()
+        time.sleep(0.1)
+        self.assertEqual(2, q.get())
+        putter.join()
+        self.assertEqual(3, q.get())
+
+        for _ in range(2):
+            q.task_done()
+        joiner = threading.Thread(target=q.join)
+        joiner.start()
+        time.sleep(0.1)
+        self.assertTrue(joiner.is_alive())
+        q.task_done()
+        joiner.join()
+
+    def test_put_many_get_many_wrap_around(self):
+        q = Queue(4)
+        q.put_many((1, 2, 3))
+        self.assertEqual((1, 2), q.get_many(2))
+        q.put_many((4, 5, 6))
+        self.assertEqual((3, 4, 5, 6), q.get_many(4))
+
+    def test_spsc_needs_maxsize(self):
+        with self.assertRaises(ValueError):
+            Queue(spsc=True)
+
+    def test_spsc_maxsize_too_large_to_preallocate(self):
+        for maxsize in (2 ** 61, 2 ** 62, 2 ** 63 - 1):
+            with self.assertRaises(OverflowError):
+                Queue(maxsize, spsc=True)
+
+        with self.assertRaises(MemoryError):
+            Queue(2 ** 60, spsc=True)
+
+    def test_spsc_with_threads(self):
+        q = Queue(3, spsc=True)
+
+        def producer():
+            for x in range(200):
+                q.put(x)
+            q.put_many(range(200, 203))
+
+        t = threading.Thread(target=producer)
+        t.start()
+        self.assertEqual(range(200), [q.get(True, 4) for _ in range(200)])
+        self.assertEqual((200, 201, 202), q.get_many(3))
+        t.join()
+
+        with self.assertRaises(Empty):
+            q.get(block=False)
+
+    def test_put_many_wakes_all_needed_getters(self):
+        q = Queue()
+        got = []
+        getters = [
+            threading.Thread(target=lambda: got.append(q.get(True, 5)))
+            for _ in range(3)]
+        [t.start() for t in getters]
+        time.sleep(0.2)
+
+        start = time.time()
+        q.put_many((1, 2, 3))
+        [t.join() for t in getters]
+        self.assertEqual([1, 2, 3], sorted(got))
+        self.assertLess(time.time() - start, 4)